@@ -21,7 +21,11 @@ setup(
     license="MIT",
     packages=["smalld_click"],
     use_scm_version=True,
-    install_requires=["smalld>=0.1.4", "click>=7.1.2"],
+    install_requires=[
+        "smalld>=0.1.4",
+        "click>=7.1.2",
+        "contextvars>=2.4;python_version<'3.7'",
+    ],
     setup_requires=["setuptools-scm==4.1.2"],
     classifiers=[
         "Development Status :: 4 - Beta",
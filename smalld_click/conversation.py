@@ -1,38 +1,78 @@
-import io
+import functools
+import logging
+import threading
+from contextvars import ContextVar
 
 import click
 
 click_prompt = click.prompt
 click_echo = click.echo
 
+logger = logging.getLogger("smalld_click")
 
 MESSAGE_CHARACTERS_LIMIT = 2000
 
+current_conversation = ContextVar("current_conversation", default=None)
+
 
 class Conversation:
     def __init__(self, runner, message):
         self.runner = runner
         self.message = message
         self.smalld = runner.smalld
+        self.post = runner.smalld.post
+        self.create_message = runner.create_message
         self.channel_id = message.channel_id
+        self.messages_route = messages_route(self.channel_id)
         self.user_id = message.author.id
-        self.echo_buffer = io.StringIO()
+        self.echo_buffer = EchoBuffer()
+        self.echo_lock = threading.RLock()
+        self.flush_interval = runner.flush_interval
+        self.flush_timer = None
         self.is_safe = False
+        self.token = None
 
     def ensure_safe(self):
         if self.is_safe:
             return
 
-        channel = self.runner.smalld.post(
-            "/users/@me/channels", {"recipient_id": self.user_id}
-        )
+        channel = self.post("/users/@me/channels", {"recipient_id": self.user_id})
         self.channel_id = channel["id"]
+        self.messages_route = messages_route(self.channel_id)
         self.is_safe = True
 
     def say(self, message=None, nl=True, file=None, *args, flush=False, **kwargs):
-        click_echo(message, file=self.echo_buffer, nl=nl, *args, **kwargs)
-        if flush:
+        if message is None:
+            message = ""
+
+        # plain text needs none of click's conversions or ANSI stripping.
+        plain = isinstance(message, str) and "\x1b" not in message
+        with self.echo_lock:
+            if plain and not (args or kwargs):
+                self.echo_buffer.write(message + "\n" if nl else message)
+            else:
+                click_echo(message, file=self.echo_buffer, nl=nl, *args, **kwargs)
+
+            if flush:
+                self.flush()
+                return
+
+            if self.echo_buffer.size >= MESSAGE_CHARACTERS_LIMIT:
+                self.flush(partial=True)
+            if self.echo_buffer.size and self.flush_interval:
+                if self.flush_timer is None:
+                    self.schedule_flush()
+
+    def schedule_flush(self):
+        self.flush_timer = threading.Timer(self.flush_interval, self.timed_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def timed_flush(self):
+        try:
             self.flush()
+        except Exception:
+            logger.exception("failed to send echoed text")
 
     def ask(self, text, default=None, hide_input=False, *args, **kwargs):
         if hide_input:
@@ -46,28 +86,71 @@ class Conversation:
         )
         return message.content
 
-    def flush(self):
-        content = self.echo_buffer.getvalue()
-        self.echo_buffer = io.StringIO()
+    def flush(self, partial=False):
+        with self.echo_lock:
+            if self.flush_timer is not None and not partial:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            content = self.echo_buffer.getvalue()
+            self.echo_buffer.clear()
+
+            if partial:
+                # only send full messages, the rest is kept for later.
+                end = len(content) - len(content) % MESSAGE_CHARACTERS_LIMIT
+                content, rest = content[:end], content[end:]
+                self.echo_buffer.write(rest)
 
-        for message in chunked(content, MESSAGE_CHARACTERS_LIMIT):
-            if message.strip():
-                message = self.runner.create_message(message)
-                self.smalld.post(f"/channels/{self.channel_id}/messages", message)
+            for message in chunked(content, MESSAGE_CHARACTERS_LIMIT):
+                if message.strip():
+                    self.post(self.messages_route, self.create_message(message))
 
     def close(self):
-        self.__exit__(None, None, None)
+        self.flush()
         click.get_current_context().abort()
 
     def __enter__(self):
+        self.token = current_conversation.set(self)
         return self
 
     def __exit__(self, type, value, traceback):
-        self.flush()
+        try:
+            self.flush()
+        finally:
+            current_conversation.reset(self.token)
+
+
+class EchoBuffer:
+    __slots__ = ("chunks", "size")
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, s):
+        if not isinstance(s, str):
+            raise TypeError(f"string argument expected, got {type(s).__name__!r}")
+        self.chunks.append(s)
+        self.size += len(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
 
 
 def get_conversation():
-    return click.get_current_context().find_object(Conversation)
+    return current_conversation.get()
+
+
+@functools.lru_cache(maxsize=4096)
+def messages_route(channel_id):
+    return f"/channels/{channel_id}/messages"
 
 
 def chunked(it, n):
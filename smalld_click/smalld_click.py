@@ -1,19 +1,43 @@
-import contextlib
+import asyncio
+import heapq
 import logging
+import os
+import re
 import shlex
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import click
 from pkg_resources import get_distribution
 
 from .conversation import Conversation
-from .utils import Completable, patch_click_functions, restore_click_functions
+from .utils import (
+    Completable,
+    RateLimit,
+    patch_click_functions,
+    restore_click_functions,
+)
 
 __version__ = get_distribution("smalld-click").version
 
 
 logger = logging.getLogger("smalld_click")
 
+# quotes, escapes and whitespace that shlex does not split on.
+SHLEX_SPECIAL_CHARACTERS = re.compile(r"[\"'\\]|(?![ \t\r\n])\s")
+
+# commands mostly wait on discord and on users, not on the cpu.
+DEFAULT_MAX_WORKERS = (os.cpu_count() or 1) * 8
+
+# formatting tracebacks is expensive, a command failing repeatedly under load
+# only gets a few of them logged per minute.
+traceback_rate_limit = RateLimit(10, 60)
+
+# commands are dropped under floods, don't log every single one of them.
+dropped_command_rate_limit = RateLimit(1, 10)
+
 
 class SmallDCliRunner:
     def __init__(
@@ -25,6 +49,10 @@ class SmallDCliRunner:
         timeout=60,
         create_message=None,
         executor=None,
+        max_workers=None,
+        max_inflight=None,
+        max_queued_per_key=4,
+        flush_interval=None,
     ):
         self.prefix = prefix.strip()
         self.name = name.strip() if name is not None else cli.name or ""
@@ -32,12 +60,29 @@ class SmallDCliRunner:
         if not self.prefix and not self.name:
             raise ValueError("either prefix or name must be non empty")
 
+        self.info_name = self.prefix + self.name
+
         self.smalld = smalld
+        self.bot_id = None
         self.cli = cli
         self.timeout = timeout
+        self.flush_interval = flush_interval
         self.create_message = create_message if create_message else plain_message
-        self.executor = executor if executor else ThreadPoolExecutor()
+        max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.executor = (
+            executor
+            if executor
+            else ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="smalld-click"
+            )
+        )
         self.pending = {}
+        self.pending_expiry = []
+        self.pending_lock = threading.Lock()
+        self.queues = {}
+        self.queues_lock = threading.Lock()
+        self.max_queued_per_key = max_queued_per_key
+        self.inflight = threading.BoundedSemaphore(max_inflight or 4 * max_workers)
 
     def __enter__(self):
         patch_click_functions()
@@ -60,7 +105,11 @@ class SmallDCliRunner:
         content = getattr(msg, "content", None) or ""
         channel_id = msg.channel_id
 
-        handle = self.pending.pop((user_id, channel_id), None)
+        if self.pending_expiry:
+            self.remove_expired_pending()
+
+        key = (user_id, channel_id)
+        handle = self.take_pending(key)
         if handle is not None:
             handle.complete_with(msg)
             return
@@ -69,31 +118,123 @@ class SmallDCliRunner:
         if args is None:
             return
 
-        return self.executor.submit(self.handle_command, msg, args)
+        return self.submit_command(key, msg, args)
+
+    async def on_message_async(self, msg):
+        future = self.on_message(msg)
+        if future is not None:
+            return asyncio.wrap_future(future)
+
+    def submit_command(self, key, msg, args):
+        future = Future()
+        dropped = None
+        with self.queues_lock:
+            queue = self.queues.get(key)
+            if queue is not None and len(queue) >= self.max_queued_per_key:
+                dropped = "too many commands queued for user"
+            elif not self.inflight.acquire(blocking=False):
+                dropped = "too many commands in flight"
+            else:
+                if queue is None:
+                    queue = self.queues[key] = deque()
+                queue.append((future, msg, args))
+                if len(queue) > 1:
+                    return future
+
+        # logging may be slow, keep it out of the lock message dispatch needs.
+        if dropped is not None:
+            log_dropped_command(dropped)
+            return None
 
-    def handle_command(self, msg, args):
-        info_name = self.prefix + self.name
-        with managed_click_execution() as manager:
-            conversation = Conversation(self, msg)
-            parent_ctx = click.Context(self.cli, info_name=info_name, obj=conversation)
-
-            manager.enter_context(parent_ctx)
-            manager.enter_context(conversation)
+        try:
+            self.executor.submit(self.drain_queue, key)
+        except BaseException:
+            self.discard_queue(key)
+            raise
+        return future
+
+    def discard_queue(self, key):
+        with self.queues_lock:
+            queue = self.queues.pop(key)
+
+        for future, _, _ in queue:
+            self.inflight.release()
+            future.cancel()
+
+    def drain_queue(self, key):
+        with self.queues_lock:
+            queue = self.queues[key]
+
+        while True:
+            future, msg, args = queue[0]
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = self.handle_command(msg, args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+            self.inflight.release()
+            with self.queues_lock:
+                queue.popleft()
+                if not queue:
+                    del self.queues[key]
+                    return
 
-            args_list = split_args(args)
-            ctx = self.cli.make_context("", args_list, parent=parent_ctx)
-            manager.enter_context(ctx)
+    def handle_command(self, msg, args):
+        conversation = Conversation(self, msg)
+        parent_ctx = click.Context(self.cli, info_name=self.info_name, obj=conversation)
 
-            self.cli.invoke(ctx)
+        # errors are handled before the conversation exits, so they get flushed.
+        with parent_ctx, conversation, ManagedClickExecution():
+            ctx = self.cli.make_context("", split_args(args), parent=parent_ctx)
+            with ctx:
+                self.cli.invoke(ctx)
 
     def wait_for_message(self, user_id, channel_id):
+        key = (user_id, channel_id)
         handle = Completable()
-        self.pending[(user_id, channel_id)] = handle
-        if handle.wait(self.timeout):
-            return handle.result
-        self.pending.pop((user_id, channel_id), None)
+        self.add_pending(key, handle)
+        try:
+            if handle.wait(self.timeout):
+                return handle.result
+        finally:
+            self.remove_pending(key, handle)
         raise TimeoutError("timed out while waiting for user response")
 
+    def add_pending(self, key, handle):
+        deadline = time.monotonic() + self.timeout
+        with self.pending_lock:
+            self.pending[key] = (handle, deadline)
+            heapq.heappush(self.pending_expiry, (deadline, key))
+
+    def take_pending(self, key):
+        with self.pending_lock:
+            handle, deadline = self.pending.pop(key, (None, 0))
+        return handle if deadline > time.monotonic() else None
+
+    def remove_pending(self, key, handle):
+        with self.pending_lock:
+            pending_handle, _ = self.pending.get(key, (None, 0))
+            if pending_handle is handle:
+                del self.pending[key]
+
+    def remove_expired_pending(self):
+        now = time.monotonic()
+        with self.pending_lock:
+            expiry = self.pending_expiry
+            while expiry and expiry[0][0] < now:
+                deadline, key = heapq.heappop(expiry)
+                _, pending_deadline = self.pending.get(key, (None, None))
+                if pending_deadline == deadline:
+                    del self.pending[key]
+
+
+def log_dropped_command(reason):
+    if dropped_command_rate_limit.acquire():
+        logger.warning("dropping command, %s", reason)
+
 
 def plain_message(msg):
     return {"content": msg}
@@ -106,30 +247,45 @@ def parse_command(prefix, name, message):
     cmd = message[len(prefix) :].lstrip()
     if not name:
         return cmd
-    elif not cmd:
+    elif not cmd.startswith(name):
         return None
 
-    cmd_name, *args = cmd.split(maxsplit=1)
-    return "".join(args) if cmd_name == name else None
+    args = cmd[len(name) :]
+    if args and not args[0].isspace():
+        return None
+    return args.lstrip()
 
 
 def split_args(command):
+    if not SHLEX_SPECIAL_CHARACTERS.search(command):
+        return command.split()
+
     try:
         return shlex.split(command)
     except ValueError as e:
         click.get_current_context().fail(e.args[0])
 
 
-@contextlib.contextmanager
-def managed_click_execution():
-    with contextlib.ExitStack() as es:
-        try:
-            yield es
-        except click.exceptions.ClickException as e:
-            e.show()
-        except (click.exceptions.Exit, click.exceptions.Abort) as e:
+class ManagedClickExecution:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
             pass
-        except TimeoutError:
+        elif issubclass(exc_type, click.exceptions.ClickException):
+            exc_value.show()
+        elif issubclass(
+            exc_type, (click.exceptions.Exit, click.exceptions.Abort, TimeoutError)
+        ):
             pass
-        except:
-            logger.exception("exception in command handler")
+        elif traceback_rate_limit.acquire():
+            logger.exception(
+                "exception in command handler",
+                exc_info=(exc_type, exc_value, traceback),
+            )
+        else:
+            logger.error("exception in command handler: %r", exc_value)
+        return True
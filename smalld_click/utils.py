@@ -1,40 +1,69 @@
 import threading
+import time
 
 import click
 
-from .conversation import get_conversation
+from .conversation import current_conversation
+
+# bound once, so patched functions skip the get_conversation() call.
+get_conversation = current_conversation.get
 
 
 class Completable:
+    __slots__ = ("_event", "result")
+
     def __init__(self):
-        self._condition = threading.Condition()
-        self._result = None
+        self._event = threading.Event()
+        self.result = None
 
     def wait(self, timeout=None):
-        with self._condition:
-            return self._condition.wait(timeout)
+        return self._event.wait(timeout)
 
     def complete_with(self, result):
-        with self._condition:
-            self._result = result
-            self._condition.notify()
+        self.result = result
+        self._event.set()
+
+
+class RateLimit:
+    __slots__ = ("rate", "per", "allowance", "last_check", "lock")
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.allowance = rate
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
 
-    @property
-    def result(self):
-        with self._condition:
-            return self._result
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed, self.last_check = now - self.last_check, now
+            self.allowance = min(
+                self.rate, self.allowance + elapsed * self.rate / self.per
+            )
+            if self.allowance < 1:
+                return False
+            self.allowance -= 1
+            return True
+
+
+def active_conversation():
+    conversation = get_conversation()
+    if conversation is None:
+        raise RuntimeError("There is no active conversation.")
+    return conversation
 
 
 def echo(*args, **kwargs):
-    return get_conversation().say(*args, **kwargs)
+    return active_conversation().say(*args, **kwargs)
 
 
 def prompt(*args, **kwargs):
-    return get_conversation().ask(*args, **kwargs)
+    return active_conversation().ask(*args, **kwargs)
 
 
 def prompt_func(prompt):
-    return get_conversation().get_reply(prompt)
+    return active_conversation().get_reply(prompt)
 
 
 click_prompt = click.prompt
@@ -65,11 +94,26 @@ def set_click_functions(echo, prompt, visible_prompt, hidden_prompt):
     click.termui.hidden_prompt_func = hidden_prompt
 
 
+patch_lock = threading.Lock()
+patch_count = 0
+
+
 def patch_click_functions():
-    set_click_functions(echo, prompt, prompt_func, prompt_func)
+    global patch_count
+    with patch_lock:
+        if patch_count == 0:
+            set_click_functions(echo, prompt, prompt_func, prompt_func)
+        patch_count += 1
 
 
 def restore_click_functions():
-    set_click_functions(
-        click_echo, click_prompt, click_visible_prompt_func, click_hidden_prompt_func
-    )
+    global patch_count
+    with patch_lock:
+        patch_count = max(patch_count - 1, 0)
+        if patch_count == 0:
+            set_click_functions(
+                click_echo,
+                click_prompt,
+                click_visible_prompt_func,
+                click_hidden_prompt_func,
+            )
@@ -1,13 +1,21 @@
+import asyncio
+import os
+import shlex
+import threading
 import time
 from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from types import SimpleNamespace
-from unittest.mock import Mock, call
+from typing import NamedTuple, Optional
 
 import click
 
 import pytest
 from smalld_click import SmallDCliRunner, get_conversation
+from smalld_click.conversation import messages_route
+from smalld_click.smalld_click import split_args
+from smalld_click.utils import Completable, RateLimit
 
 AUTHOR_ID = "author_id"
 BOT_ID = "bot_id"
@@ -19,10 +27,18 @@ POST_DM_MESSAGE_ROUTE = f"/channels/{DM_CHANNEL_ID}/messages"
 POST_OPEN_DM_ROUTE = "/users/@me/channels"
 
 
+class Author(NamedTuple):
+    id: str
+
+
+class Message(NamedTuple):
+    content: Optional[str]
+    channel_id: str
+    author: Author
+
+
 def make_message(content, author_id=AUTHOR_ID, channel_id=CHANNEL_ID):
-    return SimpleNamespace(
-        content=content, channel_id=channel_id, author=SimpleNamespace(id=author_id)
-    )
+    return Message(content, channel_id, Author(author_id))
 
 
 def assert_completes(future_or_futures, timeout=0.5):
@@ -36,22 +52,37 @@ def assert_completes(future_or_futures, timeout=0.5):
         raise AssertionError("timed out waiting for future to complete")
 
 
+class RecordingSmallD:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, route, data=None):
+        self.posts.append((route, data))
+        if route == GET_DM_CHANNEL_ROUTE:
+            return {"id": DM_CHANNEL_ID}
+
+    def on_ready(self, listener):
+        pass
+
+    def on_message_create(self, listener):
+        pass
+
+
 @pytest.fixture
 def smalld():
-    mock = Mock()
+    return RecordingSmallD()
 
-    def post_side_effect(route, data=None):
-        if route == "/users/@me/channels":
-            return {"id": DM_CHANNEL_ID}
 
-    mock.post.side_effect = post_side_effect
-    return mock
+@pytest.fixture
+def executor():
+    return ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4))
 
 
 @pytest.fixture
-def make_subject(request, smalld):
+def make_subject(request, smalld, executor):
     def factory(*args, **kwargs):
         kwargs.setdefault("timeout", 1)
+        kwargs.setdefault("executor", executor)
         subject = SmallDCliRunner(smalld, *args, **kwargs).__enter__()
         subject.on_ready(SimpleNamespace(user=SimpleNamespace(id=BOT_ID)))
         request.addfinalizer(partial(subject.__exit__, None, None, None))
@@ -60,6 +91,29 @@ def make_subject(request, smalld):
     return factory
 
 
+def test_completable_returns_result_completed_from_another_thread():
+    completable = Completable()
+    threading.Timer(0.1, completable.complete_with, args=("result",)).start()
+
+    assert completable.wait(1)
+    assert completable.result == "result"
+
+
+def test_completable_returns_result_completed_before_waiting():
+    completable = Completable()
+    completable.complete_with("result")
+
+    assert completable.wait(0)
+    assert completable.result == "result"
+
+
+def test_completable_times_out_when_not_completed():
+    completable = Completable()
+
+    assert not completable.wait(0.1)
+    assert completable.result is None
+
+
 def test_raises_error_for_empty_prefix_and_name(make_subject):
     @click.command()
     def command():
@@ -85,6 +139,19 @@ def test_exposes_correct_context(make_subject):
     assert conversation is not None
     assert conversation.runner is subject
     assert conversation.message is data
+    assert get_conversation() is None
+    assert subject.executor.submit(get_conversation).result() is None
+
+
+def test_resets_context_after_handling_command_directly(make_subject):
+    @click.command()
+    def command():
+        click.echo("echo")
+
+    subject = make_subject(command)
+    subject.handle_command(make_message("command"), "")
+
+    assert get_conversation() is None
 
 
 def test_parses_command(make_subject):
@@ -105,6 +172,43 @@ def test_parses_command(make_subject):
     assert option == "option"
 
 
+def test_parses_quoted_arguments(make_subject):
+    arguments = None
+
+    @click.command()
+    @click.argument("args", nargs=-1)
+    def command(args):
+        nonlocal arguments
+        arguments = args
+
+    subject = make_subject(command)
+    f = subject.on_message(
+        make_message("command 'first arg' \"second arg\" third\\ arg")
+    )
+
+    assert_completes(f)
+    assert arguments == ("first arg", "second arg", "third arg")
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "",
+        "arg",
+        "  arg  --opt=option ",
+        "arg\t--opt\noption",
+        "arg --opt='option'",
+        'arg --opt="quoted option"',
+        "arg\\ with\\ spaces",
+        "a\xa0b",
+        "a\x0bb",
+        "a\u202fb --name=J\xa0Doe",
+    ],
+)
+def test_parses_command_fast_path(command):
+    assert split_args(command) == shlex.split(command)
+
+
 def test_parses_multicommands(make_subject):
     slots = [False, False]
 
@@ -146,6 +250,8 @@ def test_parses_multicommands(make_subject):
         ("", "invoke", "invokearg", False),
         ("", "invoke", "invoke --opt", True),
         ("", "invoke", "invoke--opt arg", False),
+        ("", "invoke", "invoker arg", False),
+        ("", "invoke", "invoke\narg", True),
         ("++", "invoke", "", False),
         ("++", "invoke", "++", False),
         ("++", "invoke", "++invoke", True),
@@ -182,22 +288,130 @@ def test_handles_echo(make_subject, smalld):
     f = subject.on_message(make_message("command"))
 
     assert_completes(f)
-    smalld.post.assert_called_once_with(POST_MESSAGE_ROUTE, {"content": "echo\n"})
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": "echo\n"})]
+
+
+def test_strips_styles_from_echo(make_subject, smalld):
+    @click.command()
+    def command():
+        click.echo(click.style("styled", fg="red"), nl=False)
+        click.echo(123)
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+
+    assert_completes(f)
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": "styled123\n"})]
+
+
+def test_keeps_buffered_echoes_when_echoing_bytes(make_subject, smalld, caplog):
+    @click.command()
+    def command():
+        click.echo("text")
+        click.echo(b"bytes")
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+
+    assert_completes(f)
+    assert f.exception() is None
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": "text\n"})]
+    assert "exception in command handler" in caplog.text
 
 
 def test_buffers_calls_to_echo(make_subject, smalld):
     @click.command()
     def command():
         click.echo("echo 1")
+        click.echo("echo 2", nl=False)
+        click.echo("echo 3")
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+
+    assert_completes(f)
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": "echo 1\necho 2echo 3\n"})]
+
+
+def test_sends_full_messages_before_command_completes(make_subject, smalld):
+    release = threading.Event()
+
+    @click.command()
+    def command():
+        click.echo("a" * 1500)
+        click.echo("b" * 1500)
+        release.wait(0.5)
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+    time.sleep(0.2)
+
+    assert smalld.posts == [
+        (POST_MESSAGE_ROUTE, {"content": "a" * 1500 + "\n" + "b" * 499})
+    ]
+    release.set()
+    assert_completes(f)
+    assert smalld.posts[-1] == (POST_MESSAGE_ROUTE, {"content": "b" * 1001 + "\n"})
+
+
+@pytest.mark.parametrize(
+    "text, sent",
+    [("echo 1", ["echo 1\n"]), ("a" * 2500, ["a" * 2000, "a" * 500 + "\n"])],
+)
+def test_flushes_echoes_after_flush_interval(make_subject, smalld, text, sent):
+    release = threading.Event()
+
+    @click.command()
+    def command():
+        click.echo(text)
+        release.wait(0.5)
         click.echo("echo 2")
 
+    subject = make_subject(command, flush_interval=0.1)
+    f = subject.on_message(make_message("command"))
+    time.sleep(0.3)
+
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": c}) for c in sent]
+    release.set()
+    assert_completes(f)
+    assert len(smalld.posts) == len(sent) + 1
+    assert smalld.posts[-1] == (POST_MESSAGE_ROUTE, {"content": "echo 2\n"})
+
+
+def test_logs_failed_timed_flushes(make_subject, smalld, caplog, monkeypatch):
+    def post(route, data=None):
+        raise RuntimeError("unavailable")
+
+    release = threading.Event()
+
+    @click.command()
+    def command():
+        click.echo("echo")
+        release.wait(0.5)
+
+    subject = make_subject(command, flush_interval=0.1)
+    monkeypatch.setattr(smalld, "post", post)
+    f = subject.on_message(make_message("command"))
+    time.sleep(0.3)
+
+    assert "failed to send echoed text" in caplog.text
+    release.set()
+    assert_completes(f)
+
+
+def test_buffers_many_echoes_into_full_messages(make_subject, smalld):
+    @click.command()
+    def command():
+        for _ in range(1000):
+            click.echo("line")
+
     subject = make_subject(command)
     f = subject.on_message(make_message("command"))
 
     assert_completes(f)
-    smalld.post.assert_called_once_with(
-        POST_MESSAGE_ROUTE, {"content": "echo 1\necho 2\n"}
-    )
+    assert len(smalld.posts) == 3
+    assert all(route == POST_MESSAGE_ROUTE for route, _ in smalld.posts)
+    assert "".join(data["content"] for _, data in smalld.posts) == "line\n" * 1000
 
 
 def test_should_not_send_empty_messages(make_subject, smalld):
@@ -209,7 +423,7 @@ def test_should_not_send_empty_messages(make_subject, smalld):
     f = subject.on_message(make_message("command"))
 
     assert_completes(f)
-    assert smalld.post.call_count == 0
+    assert len(smalld.posts) == 0
 
 
 def test_handles_prompt(make_subject, smalld):
@@ -226,37 +440,58 @@ def test_handles_prompt(make_subject, smalld):
     subject.on_message(make_message("result"))
 
     assert_completes(f)
-    smalld.post.assert_called_once_with(POST_MESSAGE_ROUTE, {"content": "prompt: "})
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": "prompt: "})]
 
 
-def test_sends_prompts_without_buffering(make_subject, smalld):
-    result1, result2 = None, None
+@pytest.mark.parametrize(
+    "sequence, expected_posts",
+    [
+        (
+            [
+                ("echo", "echo 1"),
+                ("prompt", "prompt 1"),
+                ("prompt", "prompt 2"),
+                ("echo", "echo 2"),
+            ],
+            ["echo 1\nprompt 1: ", "prompt 2: ", "echo 2\n"],
+        ),
+        (
+            [("echo", "echo 1"), ("echo", "echo 2"), ("prompt", "prompt 1")],
+            ["echo 1\necho 2\nprompt 1: "],
+        ),
+        ([("prompt", "prompt 1"), ("echo", "echo 1")], ["prompt 1: ", "echo 1\n"]),
+        (
+            [("prompt", "prompt 1"), ("prompt", "prompt 2")],
+            ["prompt 1: ", "prompt 2: "],
+        ),
+    ],
+)
+def test_sends_prompts_without_buffering(
+    make_subject, smalld, sequence, expected_posts
+):
+    results = []
 
     @click.command()
     def command():
-        nonlocal result1, result2
-        click.echo("echo 1")
-        result1 = click.prompt("prompt 1")
-        result2 = click.prompt("prompt 2")
-        click.echo("echo 2")
+        for action, text in sequence:
+            if action == "echo":
+                click.echo(text)
+            else:
+                results.append(click.prompt(text))
 
     subject = make_subject(command)
+    prompts = sum(action == "prompt" for action, _ in sequence)
 
     f = subject.on_message(make_message("command"))
-    time.sleep(0.2)
-    subject.on_message(make_message("result"))
-    time.sleep(0.2)
-    subject.on_message(make_message("result"))
+    for _ in range(prompts):
+        time.sleep(0.2)
+        subject.on_message(make_message("result"))
 
     assert_completes(f)
-    smalld.post.assert_has_calls(
-        [
-            call(POST_MESSAGE_ROUTE, {"content": "echo 1\nprompt 1: "}),
-            call(POST_MESSAGE_ROUTE, {"content": "prompt 2: "}),
-            call(POST_MESSAGE_ROUTE, {"content": "echo 2\n"}),
-        ]
-    )
-    assert result1 == result2 == "result"
+    assert smalld.posts == [
+        (POST_MESSAGE_ROUTE, {"content": post}) for post in expected_posts
+    ]
+    assert results == ["result"] * prompts
 
 
 def test_drops_conversation_when_timed_out(make_subject):
@@ -271,6 +506,31 @@ def test_drops_conversation_when_timed_out(make_subject):
     assert not subject.pending
 
 
+def test_drops_only_expired_conversations(make_subject, monkeypatch):
+    now = 100
+
+    def monotonic():
+        return now
+
+    monkeypatch.setattr(
+        "smalld_click.smalld_click.time", SimpleNamespace(monotonic=monotonic)
+    )
+
+    @click.command()
+    def command():
+        pass
+
+    subject = make_subject(command, timeout=10)
+    subject.add_pending(("first", "channel"), Completable())
+    now = 105
+    subject.add_pending(("second", "channel"), Completable())
+    now = 111
+    subject.on_message(make_message("not a command"))
+
+    assert list(subject.pending) == [("second", "channel")]
+    assert len(subject.pending_expiry) == 1
+
+
 def test_prompts_in_DM_for_hidden_prompts(make_subject, smalld):
     @click.command()
     def command():
@@ -280,7 +540,10 @@ def test_prompts_in_DM_for_hidden_prompts(make_subject, smalld):
     subject.on_message(make_message("command"))
     time.sleep(0.2)
 
-    assert smalld.post.called_with(POST_DM_MESSAGE_ROUTE, {"content": "prompt: "})
+    assert smalld.posts == [
+        (POST_OPEN_DM_ROUTE, {"recipient_id": AUTHOR_ID}),
+        (POST_DM_MESSAGE_ROUTE, {"content": "prompt: "}),
+    ]
 
 
 def test_only_responds_to_hidden_prompts_answers_in_DM(make_subject, smalld):
@@ -316,14 +579,11 @@ def test_continues_conversation_in_DM_after_hidden_prompt(make_subject, smalld):
     subject.on_message(make_message("result", channel_id=DM_CHANNEL_ID))
 
     assert_completes(f)
-    assert smalld.post.call_count == 3
-    smalld.post.assert_has_calls(
-        [
-            call(POST_OPEN_DM_ROUTE, {"recipient_id": AUTHOR_ID}),
-            call(POST_DM_MESSAGE_ROUTE, {"content": "echo 1\nprompt: "}),
-            call(POST_DM_MESSAGE_ROUTE, {"content": "echo 2\n"}),
-        ]
-    )
+    assert smalld.posts == [
+        (POST_OPEN_DM_ROUTE, {"recipient_id": AUTHOR_ID}),
+        (POST_DM_MESSAGE_ROUTE, {"content": "echo 1\nprompt: "}),
+        (POST_DM_MESSAGE_ROUTE, {"content": "echo 2\n"}),
+    ]
 
 
 def test_patches_click_functions_in_context_only(smalld):
@@ -348,6 +608,44 @@ def test_patches_click_functions_in_context_only(smalld):
     assert click.prompt is click_prompt
 
 
+def test_raises_error_for_click_functions_outside_of_command(smalld):
+    @click.command()
+    def command():
+        pass
+
+    with SmallDCliRunner(smalld, command):
+        with pytest.raises(RuntimeError, match="no active conversation"):
+            click.echo("echo")
+        with pytest.raises(RuntimeError, match="no active conversation"):
+            click.prompt("prompt")
+        with pytest.raises(RuntimeError, match="no active conversation"):
+            click.termui.visible_prompt_func("prompt")
+
+    assert get_conversation() is None
+
+
+def test_restores_click_functions_when_last_runner_exits(smalld):
+    from smalld_click.utils import echo, click_echo
+
+    @click.command()
+    def command():
+        pass
+
+    with SmallDCliRunner(smalld, command):
+        with SmallDCliRunner(smalld, command):
+            assert click.echo is echo
+        assert click.echo is echo
+
+    assert click.echo is click_echo
+
+
+def test_reuses_messages_route_for_same_channel():
+    route = messages_route(CHANNEL_ID)
+
+    assert route == POST_MESSAGE_ROUTE
+    assert messages_route(CHANNEL_ID) is route
+
+
 def test_sends_chunked_messages_not_exceeding_message_length_limit(
     make_subject, smalld
 ):
@@ -359,13 +657,10 @@ def test_sends_chunked_messages_not_exceeding_message_length_limit(
     f = subject.on_message(make_message("command"))
 
     assert_completes(f)
-    assert smalld.post.call_count == 2
-    smalld.post.assert_has_calls(
-        [
-            call(POST_MESSAGE_ROUTE, {"content": "a" * 2000}),
-            call(POST_MESSAGE_ROUTE, {"content": "a" * 1000 + "\n"}),
-        ]
-    )
+    assert smalld.posts == [
+        (POST_MESSAGE_ROUTE, {"content": "a" * 2000}),
+        (POST_MESSAGE_ROUTE, {"content": "a" * 1000 + "\n"}),
+    ]
 
 
 def test_message_is_latest_message_payload(make_subject):
@@ -391,6 +686,16 @@ def test_message_is_latest_message_payload(make_subject):
     assert msg2.content == "result"
 
 
+def test_handles_messages_received_before_ready(smalld):
+    @click.command()
+    def command():
+        pass
+
+    with SmallDCliRunner(smalld, command) as subject:
+        f = subject.on_message(make_message("command"))
+        assert_completes(f)
+
+
 def test_ignores_messages_from_self(make_subject, smalld):
     @click.command()
     def command():
@@ -399,3 +704,253 @@ def test_ignores_messages_from_self(make_subject, smalld):
     subject = make_subject(command)
     f = subject.on_message(make_message("command", author_id=BOT_ID))
     assert f is None
+
+
+def test_runs_commands_from_same_user_and_channel_in_order(make_subject):
+    order = []
+    release = threading.Event()
+
+    @click.command()
+    @click.argument("arg")
+    def command(arg):
+        if arg == "first":
+            release.wait(0.5)
+        order.append(arg)
+
+    subject = make_subject(command)
+    f1 = subject.on_message(make_message("command first"))
+    f2 = subject.on_message(make_message("command second"))
+    time.sleep(0.2)
+
+    assert order == []
+    release.set()
+    assert_completes([f1, f2])
+    assert order == ["first", "second"]
+    assert not subject.queues
+
+
+def test_completes_async_messages_in_order(make_subject):
+    order = []
+
+    @click.command()
+    @click.argument("arg", type=int)
+    def command(arg):
+        order.append(arg)
+
+    subject = make_subject(command, max_queued_per_key=20)
+
+    async def send_messages():
+        futures = [
+            await subject.on_message_async(make_message(f"command {i}"))
+            for i in range(20)
+        ]
+        await asyncio.gather(*futures)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(send_messages(), 2))
+    finally:
+        loop.close()
+
+    assert order == list(range(20))
+
+
+def test_handles_prompt_replies_awaited_after_async_command(make_subject):
+    result = None
+
+    @click.command()
+    def command():
+        nonlocal result
+        result = click.prompt("prompt")
+
+    subject = make_subject(command)
+
+    async def send_messages():
+        future = await subject.on_message_async(make_message("command"))
+        await asyncio.sleep(0.2)
+        await subject.on_message_async(make_message("result"))
+        await future
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(send_messages(), 2))
+    finally:
+        loop.close()
+
+    assert result == "result"
+
+
+def test_runs_commands_from_different_channels_concurrently(make_subject):
+    release = threading.Event()
+
+    @click.command()
+    @click.argument("arg")
+    def command(arg):
+        if arg == "blocked":
+            release.wait(0.5)
+
+    subject = make_subject(command)
+    f1 = subject.on_message(make_message("command blocked"))
+    f2 = subject.on_message(make_message("command free", channel_id="other_channel"))
+
+    assert_completes(f2, timeout=0.3)
+    assert not f1.done()
+    release.set()
+    assert_completes(f1)
+
+
+def test_drops_commands_when_too_many_are_in_flight(make_subject):
+    release = threading.Event()
+
+    @click.command()
+    def command():
+        release.wait(0.5)
+
+    subject = make_subject(command, max_inflight=1)
+    f1 = subject.on_message(make_message("command"))
+    f2 = subject.on_message(make_message("command", channel_id="other_channel"))
+
+    assert f2 is None
+    release.set()
+    assert_completes(f1)
+
+    f3 = subject.on_message(make_message("command", channel_id="other_channel"))
+    assert_completes(f3)
+
+
+def test_drops_commands_when_too_many_are_queued_for_user(make_subject):
+    release = threading.Event()
+
+    @click.command()
+    @click.option("--block", is_flag=True)
+    def command(block):
+        if block:
+            release.wait(0.5)
+
+    subject = make_subject(command, max_workers=4)
+    fs = [subject.on_message(make_message("command --block")) for _ in range(16)]
+    f = subject.on_message(make_message("command", channel_id="other_channel"))
+
+    assert all(f is not None for f in fs[:4])
+    assert all(f is None for f in fs[4:])
+    assert_completes(f)
+    release.set()
+    assert_completes(fs[:4])
+
+
+def test_releases_queued_command_when_executor_rejects_it(make_subject, executor):
+    @click.command()
+    def command():
+        pass
+
+    subject = make_subject(command, max_inflight=1)
+    executor.shutdown()
+
+    with pytest.raises(RuntimeError):
+        subject.on_message(make_message("command"))
+    assert not subject.queues
+
+    subject.executor = ThreadPoolExecutor(max_workers=1)
+    assert_completes(subject.on_message(make_message("command")))
+
+
+def test_rate_limits_dropped_command_warnings(make_subject, caplog, monkeypatch):
+    monkeypatch.setattr(
+        "smalld_click.smalld_click.dropped_command_rate_limit", RateLimit(1, 60)
+    )
+    release = threading.Event()
+
+    @click.command()
+    def command():
+        release.wait(0.5)
+
+    subject = make_subject(command, max_inflight=1)
+    f = subject.on_message(make_message("command"))
+    for i in range(3):
+        subject.on_message(make_message("command", channel_id=f"channel_{i}"))
+    release.set()
+    assert_completes(f)
+
+    records = [r for r in caplog.records if r.name == "smalld_click"]
+    assert [r.getMessage() for r in records] == [
+        "dropping command, too many commands in flight"
+    ]
+
+
+def test_sizes_default_executor_by_cpu_count(make_subject):
+    @click.command()
+    def command():
+        pass
+
+    subject = make_subject(command, executor=None)
+    assert subject.executor._max_workers == (os.cpu_count() or 1) * 8
+
+
+def test_sizes_default_executor_by_max_workers(make_subject):
+    @click.command()
+    def command():
+        pass
+
+    subject = make_subject(command, executor=None, max_workers=2)
+    assert subject.executor._max_workers == 2
+
+
+def test_shows_click_exceptions(make_subject, smalld):
+    @click.command()
+    def command():
+        raise click.ClickException("failed")
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+
+    assert_completes(f)
+    assert smalld.posts == [(POST_MESSAGE_ROUTE, {"content": "Error: failed\n"})]
+
+
+def test_shows_usage_errors(make_subject, smalld):
+    @click.command()
+    @click.argument("arg")
+    def command(arg):
+        pass
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+
+    assert_completes(f)
+    assert len(smalld.posts) == 1
+    content = smalld.posts[0][1]["content"]
+    assert "Error: Missing argument" in content
+
+
+def test_logs_unexpected_exceptions(make_subject, caplog):
+    @click.command()
+    def command():
+        raise RuntimeError("unexpected")
+
+    subject = make_subject(command)
+    f = subject.on_message(make_message("command"))
+
+    assert_completes(f)
+    assert f.exception() is None
+    assert "exception in command handler" in caplog.text
+    assert "RuntimeError: unexpected" in caplog.text
+
+
+def test_rate_limits_logged_tracebacks(make_subject, caplog, monkeypatch):
+    monkeypatch.setattr(
+        "smalld_click.smalld_click.traceback_rate_limit", RateLimit(1, 60)
+    )
+
+    @click.command()
+    def command():
+        raise RuntimeError("unexpected")
+
+    subject = make_subject(command)
+    assert_completes(subject.on_message(make_message("command")))
+    assert_completes(subject.on_message(make_message("command")))
+
+    records = [r for r in caplog.records if r.name == "smalld_click"]
+    assert len(records) == 2
+    assert records[0].exc_info is not None
+    assert not records[1].exc_info
+    assert repr(RuntimeError("unexpected")) in records[1].getMessage()